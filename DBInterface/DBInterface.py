@@ -1,15 +1,14 @@
 # Nhập các thư viện cần thiết để làm việc với PostgreSQL
-import psycopg
-from psycopg.connection import Connection
+# psycopg_pool: Bể kết nối (connection pool) để nhiều luồng dùng chung các kết nối tới database
+from psycopg_pool import ConnectionPool
 # sql: Mô-đun giúp tạo các câu truy vấn SQL động một cách an toàn (tránh SQL Injection)
 from psycopg import sql
 from psycopg.rows import Row
 
-# Nhập thư viện để xử lý bộ nhớ đệm trong RAM (quan trọng cho việc nạp dữ liệu nhanh)
-from io import StringIO
 import pandas as pd
 from pathlib import Path
 import logging
+import os
 import uuid
 
 # Cấu hình hệ thống ghi nhật ký (logging) cơ bản
@@ -29,74 +28,141 @@ class DBInterface:
     - Nạp dữ liệu (bulk insert)
     - Truy vấn dữ liệu
     """
-    def __init__(self, db_url: str, db_schema_file: Path = Path.cwd() / "schema.sql"):
+    # Nội dung các file schema đã đọc (dùng chung cho mọi instance trong process)
+    _schema_sql: dict[Path, str] = {}
+    # Các cặp (db_url, file schema) đã chạy DDL trong process này, không cần chạy lại
+    _applied_schemas: set[tuple[str, Path]] = set()
+
+    def __init__(self, db_url: str, db_schema_file: Path = Path.cwd() / "schema.sql", max_size: int = 4,
+                 log_level: str | None = None):
         # Lấy một logger riêng cho thư viện 'psycopg' để theo dõi sát sao các hoạt động của DB
         self._logger = logging.getLogger("psycopg")
-        # Đặt mức độ DEBUG để nhìn thấy chi tiết mọi câu lệnh SQL được thực thi (hữu ích khi phát triển)
-        self._logger.setLevel("DEBUG")
+        # Mặc định INFO; đặt DEBUG (tham số log_level hoặc biến môi trường DBINTERFACE_LOG_LEVEL) để nhìn thấy
+        # chi tiết mọi câu lệnh SQL được thực thi (hữu ích khi phát triển, nhưng tốn CPU khi nạp dữ liệu lớn)
+        self._logger.setLevel(log_level or os.getenv("DBINTERFACE_LOG_LEVEL", "INFO"))
+        # Bể kết nối ghi log mỗi lần mượn/trả kết nối ở mức INFO, chỉ cần cảnh báo
+        logging.getLogger("psycopg.pool").setLevel("WARNING")
 
         self._db_url = db_url
-        # Thiết lập kết nối thực sự đến cơ sở dữ liệu
-        self._conn: Connection = psycopg.connect(self._db_url)
+        # Thiết lập bể kết nối đến cơ sở dữ liệu (tối đa max_size kết nối dùng song song).
+        # Mỗi phương thức mượn một kết nối bằng `with self._pool.connection() as conn:`; khi thoát khối with,
+        # giao dịch được commit (hoặc rollback nếu có lỗi) và kết nối được trả lại bể.
+        self._pool = ConnectionPool(self._db_url, min_size=1, max_size=max_size, open=True)
+        # Bộ nhớ đệm kiểu dữ liệu cột theo bảng, dùng cho COPY nhị phân
+        self._column_types: dict[str, dict[str, str]] = {}
 
         # Ngay khi khởi tạo, đảm bảo các bảng cần thiết được tạo ra dựa trên file schema
         self._create_table(db_schema_file)
 
     def _create_table(self, db_schema_file: Path):
-        """Hàm nội bộ: Đọc file SQL và thực thi để tạo cấu trúc bảng."""
-        self._logger.info(f"Creating tables from {db_schema_file=}")
-        # Mở file chứa định nghĩa bảng (VD: schema.sql)
-        with open(db_schema_file, "r") as f:
-            # Đọc nội dung file, chuyển sang dạng bytes (utf-8) và thực thi lệnh SQL.
-            # Việc dùng bytes giúp xử lý an toàn các ký tự đặc biệt nếu có.
-            self._conn.execute(f.read().encode("utf-8"))
+        """Hàm nội bộ: Đọc file SQL và thực thi để tạo cấu trúc bảng (chỉ một lần cho mỗi database trong process)."""
+        db_schema_file = Path(db_schema_file).resolve()
+        if (self._db_url, db_schema_file) in DBInterface._applied_schemas:
+            self._logger.debug("Tables from db_schema_file=%r already created, skipping", db_schema_file)
+            return
+
+        self._logger.info("Creating tables from db_schema_file=%r", db_schema_file)
+        # Đọc file chứa định nghĩa bảng (VD: schema.sql) dưới dạng văn bản, chỉ đọc một lần
+        if db_schema_file not in DBInterface._schema_sql:
+            DBInterface._schema_sql[db_schema_file] = db_schema_file.read_text(encoding="utf-8")
+
+        with self._pool.connection() as conn:
+            # Khóa advisory theo giao dịch: nếu nhiều process cùng khởi tạo, chỉ một process chạy DDL tại một thời điểm
+            # (khóa tự nhả khi commit)
+            conn.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (str(db_schema_file),))
+            conn.execute(DBInterface._schema_sql[db_schema_file])
             # Commit: Xác nhận lưu các thay đổi (tạo bảng) vào database vĩnh viễn.
-            self._conn.commit()
+            conn.commit()
+        DBInterface._applied_schemas.add((self._db_url, db_schema_file))
 
-    def dump_data_to_db(self, table_name: str, df: pd.DataFrame):
+    def _get_column_types(self, cur, table_name: str) -> dict[str, str]:
+        """
+        Lấy tên kiểu dữ liệu PostgreSQL (typname) của từng cột trong bảng.
+        COPY nhị phân bắt buộc phải khai báo đúng kiểu của từng cột nên kết quả được lưu lại theo bảng.
         """
-        Hàm quan trọng: Đổ dữ liệu từ Pandas DataFrame vào bảng SQL một cách hiệu quả nhất.
-        Hàm này sử dụng kỹ thuật "Bulk Insert" thông qua lệnh COPY của PostgreSQL,
-        nhanh hơn rất nhiều so với việc dùng lệnh INSERT từng dòng.
+        if table_name not in self._column_types:
+            cur.execute(
+                "SELECT a.attname, t.typname FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid "
+                "WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped ORDER BY a.attnum",
+                (table_name,),
+            )
+            self._column_types[table_name] = dict(cur.fetchall())
+        return self._column_types[table_name]
+
+    @staticmethod
+    def _to_copy_values(series: pd.Series, type_name: str) -> list:
         """
+        Chuyển một cột của DataFrame thành danh sách giá trị Python mà bộ ghi COPY nhị phân của psycopg hiểu được.
+        Giá trị thiếu (NaN/NaT/NA) được đổi thành None để ghi thành NULL.
+        """
+        if type_name in ("int2", "int4", "int8"):
+            series = series.astype("Int64")
+        elif type_name in ("float4", "float8"):
+            series = series.astype("float64")
+        elif type_name == "date":
+            # format="ISO8601": chuỗi ngày (YYYY-MM-DD...) được phân tích bằng đường nhanh, không phải đoán định dạng từng giá trị
+            series = pd.to_datetime(series, format="ISO8601").dt.date
+        elif type_name == "timestamp":
+            series = pd.to_datetime(series, format="ISO8601")
+        elif type_name in ("varchar", "text", "bpchar"):
+            # Bộ ghi nhị phân của kiểu chuỗi chỉ nhận str: đổi mọi giá trị khác (số, ...) thành chuỗi
+            return [None if pd.isna(v) else v if isinstance(v, str) else str(v) for v in series.tolist()]
+        series = series.astype(object)
+        return series.where(series.notna(), None).tolist()
+
+    @staticmethod
+    def _as_frames(df: pd.DataFrame | list[pd.DataFrame]) -> tuple[list[pd.DataFrame], list[str]]:
+        """
+        Chuẩn hóa dữ liệu đầu vào thành danh sách DataFrame cùng danh sách cột chung (hợp các cột, giữ thứ tự xuất hiện).
+        """
+        frames = [df] if isinstance(df, pd.DataFrame) else [f for f in df if f is not None and not f.empty]
+        columns = list(dict.fromkeys(c for f in frames for c in f.columns))
+        return frames, columns
+
+    def _copy_dataframe(self, cur, table_name: str, df: pd.DataFrame | list[pd.DataFrame],
+                        types_from: str | None = None, chunk_rows: int = 10_000):
         """
-        Dump a pandas DataFrame from a csv file to a PostgreSQL table.
-        (Phần docstring tiếng Anh gốc giữ nguyên để tham khảo)
-        ...
+        Ghi DataFrame vào bảng bằng COPY ... (FORMAT BINARY), từng dòng một qua copy.write_row().
+        Dữ liệu được chuyển đổi theo từng khối chunk_rows dòng để bộ nhớ tạm không phình theo kích thước bảng.
+        Có thể truyền một danh sách DataFrame (vd. mỗi mã một DataFrame): tất cả được ghi trong cùng một lệnh COPY
+        mà không cần nối (concat) thành một DataFrame lớn trước.
+        :param cur: Con trỏ đang nằm trong giao dịch
+        :param table_name: Bảng đích của lệnh COPY
+        :param df: Dữ liệu cần ghi (một DataFrame hoặc danh sách DataFrame), tên cột phải trùng với tên cột trong bảng
+        :param types_from: Bảng dùng để tra kiểu dữ liệu (mặc định là chính table_name)
+        :param chunk_rows: Số dòng được chuyển đổi và gửi đi trong mỗi khối
         """
-        self._logger.info(f"Dumping data to {table_name=}")
-        # Tạo con trỏ (cursor) để thực thi lệnh trong một giao dịch (transaction)
-        with self._conn.cursor() as cur:
-            # Bắt đầu lệnh COPY.
-            # Sử dụng sql.SQL và sql.Identifier để chèn tên bảng một cách an toàn,
-            # tránh nguy cơ bảo mật SQL Injection.
-            with cur.copy(sql.SQL("COPY {} FROM STDIN WITH CSV HEADER DELIMITER ','").format(
-                sql.Identifier(table_name)
-            )) as copy:
-                # KỸ THUẬT TỐI ƯU TỐC ĐỘ:
-                # 1. Tạo một bộ nhớ đệm trong RAM (StringIO) thay vì ghi file ra ổ cứng.
-                csv_buffer = StringIO()
-                # 2. Ghi dữ liệu từ DataFrame vào bộ nhớ đệm này dưới dạng CSV.
-                df.to_csv(csv_buffer, sep=",", index=False)
-                # 3. Đưa con trỏ đọc về đầu bộ nhớ đệm.
-                csv_buffer.seek(0)
-                # 4. Đọc dữ liệu từ bộ nhớ đệm và "bơm" thẳng vào luồng COPY của database.
-                copy.write(csv_buffer.read())
-
-            # Sau khi copy xong hết dữ liệu, commit giao dịch để lưu lại.
-            self._conn.commit()
-
-    def upsert_data_to_db(self, table_name: str, df: pd.DataFrame, primary_keys: list[str]):
+        column_types = self._get_column_types(cur, types_from or table_name)
+        frames, columns = self._as_frames(df)
+        types = [column_types[c] for c in columns]
+        with cur.copy(self._copy_sql(table_name, tuple(columns))) as copy:
+            copy.set_types(types)
+            for frame in frames:
+                # Cột còn thiếu trong một DataFrame được ghi thành NULL, như khi concat
+                if list(frame.columns) != columns:
+                    frame = frame.reindex(columns=columns)
+                for start in range(0, len(frame), chunk_rows):
+                    chunk = frame.iloc[start:start + chunk_rows]
+                    values = [self._to_copy_values(chunk[c], t) for c, t in zip(columns, types)]
+                    for row in zip(*values):
+                        copy.write_row(row)
+
+    def upsert_data_to_db(self, table_name: str, df: pd.DataFrame | list[pd.DataFrame], primary_keys: list[str],
+                          update_existing: bool = True):
         """
         Upsert a pandas DataFrame into a PostgreSQL table using COPY into a temporary
         table and then an INSERT ... ON CONFLICT DO UPDATE statement to merge records.
 
         :param table_name: target table name in the database
-        :param df: pandas DataFrame containing data to upsert
+        :param df: pandas DataFrame containing data to upsert, or a list of DataFrames (e.g. one per ticker)
+            streamed one after another into the same COPY
         :param primary_keys: list of column names that form the primary key / conflict target
+        :param update_existing: if False, rows whose primary key already exists are skipped
+            (ON CONFLICT DO NOTHING) instead of updated, i.e. only new rows are inserted
         """
-        if df is None or df.empty:
-            self._logger.debug(f"No data to upsert for {table_name}")
+        frames, cols = self._as_frames(df if df is not None else [])
+        if not any(len(f) for f in frames):
+            self._logger.debug("No data to upsert for %s", table_name)
             return {"inserted": 0, "updated": 0}
 
         # Ensure primary keys provided
@@ -106,58 +172,40 @@ class DBInterface:
         # Use a temporary table unique per call
         temp_table = f"tmp_{table_name}_{uuid.uuid4().hex[:8]}"
 
-        with self._conn.cursor() as cur:
-            # Create a temporary table LIKE the target table (including constraints/columns)
+        with self._pool.connection() as conn, conn.cursor() as cur:
+            # Create an index-free temporary table LIKE the target table (columns/defaults only) so COPY
+            # skips index maintenance; ON COMMIT DROP removes it on commit, no explicit DROP needed
             cur.execute(
-                sql.SQL("CREATE TEMP TABLE {} (LIKE {} INCLUDING ALL)").format(
+                sql.SQL("CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP").format(
                     sql.Identifier(temp_table), sql.Identifier(table_name)
                 )
             )
 
-            # COPY DataFrame into temp table
-            with cur.copy(sql.SQL("COPY {} FROM STDIN WITH CSV HEADER DELIMITER ','").format(sql.Identifier(temp_table))) as copy:
-                csv_buffer = StringIO()
-                df.to_csv(csv_buffer, sep=",", index=False)
-                csv_buffer.seek(0)
-                copy.write(csv_buffer.read())
-
-            # Compute counts to log how many rows will be inserted vs updated
-            # Total rows in temp table
-            cur.execute(sql.SQL("SELECT COUNT(*) FROM {};").format(sql.Identifier(temp_table)))
-            row = cur.fetchone()
-            temp_count = row[0] if row else 0
-
-            # Count how many rows in target would match (based on primary keys)
-            # Build join condition t.pk = tt.pk AND ...
-            join_conditions = sql.SQL(' AND ').join([
-                sql.SQL("t.{0} = tt.{0}").format(sql.Identifier(pk)) for pk in primary_keys
-            ])
-            count_match_sql = sql.SQL("SELECT COUNT(*) FROM {target} t JOIN {temp} tt ON {cond};").format(
-                target=sql.Identifier(table_name), temp=sql.Identifier(temp_table), cond=join_conditions
-            )
-            cur.execute(count_match_sql)
-            row = cur.fetchone()
-            match_count = row[0] if row else 0
+            # Binary COPY of the DataFrame into temp table (column types are looked up on the target table,
+            # the temp table has the same columns)
+            self._copy_dataframe(cur, temp_table, frames, types_from=table_name)
 
             # Build the INSERT ... ON CONFLICT ... DO UPDATE statement
-            cols = list(df.columns)
             cols_ident = sql.SQL(', ').join([sql.Identifier(c) for c in cols])
 
             conflict_cols = sql.SQL(', ').join([sql.Identifier(c) for c in primary_keys])
 
             # Prepare update assignments for non-PK columns
             non_pk_cols = [c for c in cols if c not in primary_keys]
-            if non_pk_cols:
+            if non_pk_cols and update_existing:
                 update_assignments = sql.SQL(', ').join([
                     sql.SQL("{} = EXCLUDED.{}").format(sql.Identifier(c), sql.Identifier(c)) for c in non_pk_cols
                 ])
                 on_conflict = sql.SQL('DO UPDATE SET {}').format(update_assignments)
             else:
-                # If there are no non-pk columns to update, do nothing on conflict
+                # If there are no non-pk columns to update (or updates are not wanted), do nothing on conflict
                 on_conflict = sql.SQL('DO NOTHING')
 
+            # RETURNING (xmax = 0): rows created by this INSERT have xmax = 0, rows rewritten by
+            # DO UPDATE do not, which gives exact inserted/updated counts without extra COUNT queries.
             insert_sql = sql.SQL(
-                "INSERT INTO {target} ({cols}) SELECT {cols} FROM {temp} ON CONFLICT ({pks}) {onconflict}"
+                "INSERT INTO {target} ({cols}) SELECT {cols} FROM {temp} ON CONFLICT ({pks}) {onconflict} "
+                "RETURNING (xmax = 0) AS inserted"
             ).format(
                 target=sql.Identifier(table_name),
                 cols=cols_ident,
@@ -167,42 +215,22 @@ class DBInterface:
             )
 
             cur.execute(insert_sql)
+            rows = cur.fetchall()
+            inserted = sum(1 for (is_inserted,) in rows if is_inserted)
+            updated = len(rows) - inserted
 
-            # After merge, compute inserted/updated heuristically
-            inserted = temp_count - match_count
-            updated = match_count
-
-            # Drop temp table explicitly (optional; will go away at session end)
-            cur.execute(sql.SQL("DROP TABLE IF EXISTS {};").format(sql.Identifier(temp_table)))
-
-            self._conn.commit()
+            conn.commit()
 
-            self._logger.info(f"Upserted into {table_name}: inserted={inserted}, updated={updated}")
+            self._logger.info("Upserted into %s: inserted=%d, updated=%d", table_name, inserted, updated)
             return {"inserted": inserted, "updated": updated}
 
-    def get_records_with_primary_keys(self, table_name: str, ticker: str) -> list:
-        """
-        Lấy các bản ghi đã tồn tại trong DB dựa trên mã chứng khoán (ticker).
-        Thường dùng để kiểm tra xem dữ liệu đã có chưa trước khi nạp mới (tránh trùng lặp).
-        """
-        """
-        Fetch records from a PostgreSQL table based on the given table name, ticker, and columns.
-        (Phần docstring tiếng Anh gốc giữ nguyên)
-        ...
-        """
-        with self._conn.cursor() as cur:
-            # Thực thi truy vấn SELECT.
-            # - sql.Identifier: Đảm bảo tên bảng và tên cột an toàn.
-            # - %s và (ticker,): Sử dụng placeholder để truyền giá trị ticker vào an toàn.
-            cur.execute(
-                sql.SQL(
-                    "SELECT * FROM {} WHERE {} = %s",
-                ).format(sql.Identifier(table_name), sql.Identifier('ticker')),
-                (ticker,),
-            )
-            # Trả về tất cả các dòng kết quả tìm được.
-            return cur.fetchall()
+    @staticmethod
+    def _copy_sql(table_name: str, columns: tuple[str, ...]) -> sql.Composed:
+        """Câu lệnh COPY ... FROM STDIN (FORMAT BINARY) vào các cột columns của bảng table_name."""
+        return sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT BINARY)").format(
+            sql.Identifier(table_name), sql.SQL(', ').join(map(sql.Identifier, columns))
+        )
 
     def close_connection(self):
-        """Đóng kết nối database khi không dùng nữa để giải phóng tài nguyên."""
-        self._conn.close()
\ No newline at end of file
+        """Đóng bể kết nối database khi không dùng nữa để giải phóng tài nguyên."""
+        self._pool.close()
\ No newline at end of file
@@ -1,9 +1,12 @@
 import pandas as pd
-from typing import Any
+from collections import defaultdict
 from datetime import datetime, timedelta
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from FinanceApi.FinanceApi import FinanceAPI
-from util.utility import make_folder, write_data_to_file, get_table_schemas_from_sql
+from util.utility import (make_folder, write_data_to_file, read_data_from_file, write_data_to_parquet_dataset,
+                          read_data_from_parquet_dataset, get_table_schemas_from_sql, use_shared_http_session,
+                          restore_vnstock_http_client, RateLimiter)
 from DBInterface.DBInterface import DBInterface
 import logging
 
@@ -21,18 +24,33 @@ logger.setLevel("INFO")
 # Use lowercase names that match the SQL schema: e.g. 'company', 'company_profile', 'ratio', 'daily_price'
 UPSERT_TABLES = {"company", "ratio", "daily_price"}
 
+# Định dạng lưu dữ liệu ra ổ cứng: 'csv' (một file cho mỗi mã và mỗi bảng, mở được bằng Excel)
+# hoặc 'parquet' (một dataset cho mỗi bảng, chia thư mục theo mã)
+# hoặc 'none' (không lưu file, dữ liệu chỉ được ghi vào cơ sở dữ liệu)
+FILE_FORMATS = {"csv", "parquet", "none"}
+
+# Giới hạn mặc định số request HTTP gửi tới API mỗi phút (tất cả các luồng cộng lại).
+# Mỗi mã gửi khoảng 10 request (FinanceAPI.CONCURRENT_REQUESTS), nên 4 luồng tải có thể có tới 40 request cùng lúc:
+# giới hạn này giữ tốc độ trung bình ở mức an toàn với giới hạn của nhà cung cấp
+DEFAULT_REQUESTS_PER_MINUTE = 60
+
+# Kiểu dữ liệu SQL của các cột chuỗi trong schema.sql
+TEXT_SQL_TYPES = {"VARCHAR", "TEXT", "CHAR"}
+
 # Hàm gọi API để lấy dữ liệu cổ phiếu
-def call_api(api_client: FinanceAPI, stock: str, start_date: str, end_date: str) -> dict[str, pd.DataFrame]:
+def call_api(api_client: FinanceAPI, stock: str, start_date: str, end_date: str,
+             tables: list[str] | None = None) -> dict[str, pd.DataFrame | None]:
     """
     :param api_client: A FinanceAPI object
     :param stock: A str representing the stock symbol
     :param start_date: Start date in the format YYYY-MM-DD
     :param end_date: End date in the format YYYY-MM-DD
+    :param tables: Names of the tables to fetch (all tables if None)
     :return: The stock data
     """
 
     try:
-        stock_data = api_client.build_dict(stock, start_date, end_date)
+        stock_data = api_client.build_dict(stock, start_date, end_date, tables)
     # Xử lý ngoại lệ nếu có lỗi xảy ra trong quá trình gọi API
     except Exception as e:
         logger.error(e)
@@ -44,7 +62,8 @@ def call_api(api_client: FinanceAPI, stock: str, start_date: str, end_date: str)
 class DataOrchestrator:
     # Khởi tạo đối tượng DataOrchestrator
     def __init__(self, listing_df: pd.DataFrame, data_path: Path, db_url: str, db_schema_file: Path,
-                 load_from_file: bool = False, today: datetime | None = None, bearer_keys: list[str] | None = None):
+                 load_from_file: bool = False, today: datetime | None = None, bearer_keys: list[str] | None = None,
+                 max_workers: int = 4, file_format: str = "csv", requests_per_minute: float | None = DEFAULT_REQUESTS_PER_MINUTE):
         """
         Initialize a DataOrchestrator instance.
 
@@ -52,7 +71,13 @@ class DataOrchestrator:
         :param data_path: The path to store the fetched financial data
         :param db_url: The URL of the PostgreSQL database
         :param db_schema_file: The path to the SQL file containing the database schema
+        :param max_workers: Number of tickers fetched from the API at the same time
+        :param file_format: Format of the files written to data_path, one of FILE_FORMATS
+            ('none' skips writing files: the database is the only sink)
+        :param requests_per_minute: Maximum number of HTTP requests sent to the API per minute (None or 0 for no limit)
         """
+        if file_format not in FILE_FORMATS:
+            raise ValueError(f"file_format must be one of {sorted(FILE_FORMATS)}, got {file_format!r}")
         #Lấy danh sách 27 ngân hàng (listing_df) mà main.py đưa cho, và gán vào biến self.listings_df
         self.listings_df = listing_df
         # Lưu trữ đường dẫn hiện tại để lưu dữ liệu
@@ -60,21 +85,37 @@ class DataOrchestrator:
         # Lưu trữ ngày hiện tại
         self._today = today or datetime.now()
         # Khởi tạo giao diện cơ sở dữ liệu
-        self._db_interface = DBInterface(db_url, db_schema_file)
+        self._db_interface = DBInterface(db_url, db_schema_file, max_size=max_workers)
         self._db_schema = get_table_schemas_from_sql(str(db_schema_file))
+        # Khóa chính của từng bảng, tra một lần ở đây thay vì trong các vòng lặp
+        self._primary_keys: dict[str, tuple[str, ...]] = {k: tuple(v.get('primary_keys', []))
+                                                          for k, v in (self._db_schema or {}).items()}
+        # Các cột chuỗi (VARCHAR/TEXT/CHAR) của từng bảng: luôn được đọc lại từ file CSV dưới dạng chuỗi
+        self._text_columns: dict[str, tuple[str, ...]] = {
+            k: tuple(c for c, t in v.get('column_types', {}).items() if t in TEXT_SQL_TYPES)
+            for k, v in (self._db_schema or {}).items()}
         self._load_from_file = load_from_file
         self._bearer_keys = bearer_keys or []
+        # Một FinanceAPI cho mỗi bearer key, dùng chung cho mọi mã và mọi luồng (FinanceAPI không giữ trạng thái theo mã)
+        self._finance_apis = [FinanceAPI(schema_dict=(self._db_schema or {}), bearer_key=k) for k in self._bearer_keys]
+        self._max_workers = max_workers
+        self._file_format = file_format
+        # Một HTTP session dùng chung cho mọi luồng tải: giữ kết nối (keep-alive) thay vì bắt tay TCP/TLS lại mỗi lần gọi
+        # requests_per_minute: giới hạn số request gửi tới API mỗi phút cho tất cả các luồng cộng lại
+        rate_limiter = RateLimiter(requests_per_minute, burst=max_workers) if requests_per_minute else None
+        # (mỗi luồng tải gửi song song tối đa FinanceAPI.CONCURRENT_REQUESTS request, nên bể kết nối lớn tương ứng)
+        self._http_session = use_shared_http_session(max_workers * FinanceAPI.CONCURRENT_REQUESTS, rate_limiter)
 
     # Làm việc với từng cổ phiếu để lấy dữ liệu
-    def _fetch_data_worker(self, start_date: str, end_date: str, finance_api: FinanceAPI, ticker: str) -> dict[
-        str, pd.DataFrame]:
+    def _fetch_data_worker(self, start_date: str, end_date: str, finance_api: FinanceAPI, ticker: str,
+                           cached_data: dict[str, pd.DataFrame] | None = None) -> dict[str, pd.DataFrame]:
         """
         Worker function for fetching financial data for a given ticker.
 
         This function fetches financial data from the FinanceAPI instance for the given ticker
         and date range. It logs the progress and any errors that may occur during the fetch
-        process, and puts the fetched data or None (to signal an error) into the specified
-        results queue.
+        process, writes every fetched table to a CSV file and returns the fetched data
+        (or an empty dictionary to signal an error). Tables already in cached_data are not fetched again.
 
         Parameters
         ----------
@@ -88,170 +129,239 @@ class DataOrchestrator:
             The FinanceAPI instance for making API calls
         ticker: str
             The ticker symbol for the stock
+        cached_data: dict[str, pd.DataFrame] | None
+            Tables of the ticker already loaded from the files of a previous run
         """
-        #Logger thông báo bắt đầu tải dữ liệu cho mã cổ phiếu cụ thể
         try:
-            logger.info(f"Downloading data for {ticker}")
-        # tạo thư mục lưu trữ dữ liệu nếu chưa tồn tại
-            make_folder(self._cur_path / ticker)
-            make_folder(self._cur_path / ticker / end_date)
+            # Chỉ tải các bảng chưa có trong file của lần chạy trước (tiếp tục từ chỗ bị dừng)
+            missing_tables = [k for k in self._db_schema if k not in cached_data] if cached_data else None
+            #Logger thông báo bắt đầu tải dữ liệu cho mã cổ phiếu cụ thể
+            # (dùng %s thay cho f-string: thông điệp chỉ được định dạng khi mức log đang bật)
+            logger.info("Downloading data for %s", ticker)
             # Gọi API để lấy dữ liệu cổ phiếu
-            stock_data = call_api(finance_api, ticker, start_date, end_date)
-            return stock_data
+            stock_data = call_api(finance_api, ticker, start_date, end_date, missing_tables)
+            # Lưu file ra ổ cứng ngay trong luồng tải để việc ghi đĩa chạy song song với các mã khác
+            # (định dạng parquet được ghi một lần cho tất cả các mã trong run()).
+            # Bảng rỗng (vd. vnstock trả về DataFrame rỗng khi request lỗi) không được lưu, để lần chạy sau tải lại
+            for k, df in (stock_data.items() if self._file_format == "csv" else ()):
+                if isinstance(df, pd.DataFrame) and not df.empty:
+                    write_data_to_file(self._cur_path / ticker / end_date / f"{ticker}_{k}.csv", df)
+            # Gộp với các bảng đã có trong file (kể cả khi tải lỗi, để các bảng đó vẫn được ghi vào DB)
+            return {**(cached_data or {}), **stock_data}
         except Exception as e:
-            logger.error(f"Failed to fetch data for {ticker}: {e}")
-            return {}
-# Xóa các bản ghi không cần thiết khỏi dataframe trước khi lưu vào cơ sở dữ liệu
-    def _delete_unnecessary_records_from_df(self, df: pd.DataFrame, table_name: str, ticker: str, primary_keys: list[str]) -> pd.DataFrame:
+            logger.error("Failed to fetch data for %s: %s", ticker, e)
+            return dict(cached_data or {})
+    # Đọc lại dữ liệu đã lưu trên ổ cứng của một mã cổ phiếu
+    def _load_data_from_file(self, ticker: str, end_date: str) -> dict[str, pd.DataFrame] | None:
         """
-        Given these parameters, this function deletes unnecessary records from the dataframe
-        It has to get a list of records that exist in the database based on the ticker, table_name, and the primary keys of the table
-        It will then drop these records from the dataframe
-        Args:
-            df: Df to clean
-            table_name: table_name
-            ticker: ticker
-            primary_keys: primary keys
-
-        Returns: A cleaned dataframe
+        Load the cached files of a ticker for the given end date.
 
+        :param ticker: The ticker symbol for the stock
+        :param end_date: The end date used as the name of the cache folder
+        :return: A dictionary of the dataframes found (possibly only some of the tables), or None if there is none
         """
-        # Lấy các bản ghi từ cơ sở dữ liệu dựa trên khóa chính
-        primary_keys_records = self._db_interface.get_records_with_primary_keys(table_name, ticker)
-        if not primary_keys_records:
-            return df
-        # Tạo dataframe từ các bản ghi khóa chính
-        db_df = pd.DataFrame(primary_keys_records, columns=df.columns)
+        if self._file_format == "parquet":
+            return self._load_data_from_parquet(ticker, end_date)
+        if self._file_format == "none":
+            return None
+        # Loop through the files in the folder
+        cur_date_path = self._cur_path / ticker / end_date
+        # kiểm tra thư mục hiện tại có tồn tại không
+        if not cur_date_path.exists():
+            return None
+        # Đọc từng file CSV có sẵn của các bảng trong schema và lưu vào dictionary; nếu thiếu file hoặc file hỏng
+        # (lần chạy trước bị dừng giữa chừng) thì run() chỉ tải lại các bảng còn thiếu
+        stock_data_dictionary: dict[str, pd.DataFrame] = {}
+        for table_name in self._db_schema:
+            file = cur_date_path / f"{ticker}_{table_name}.csv"
+            if not file.is_file():
+                continue
+            try:
+                stock_data = read_data_from_file(file, self._text_columns.get(table_name, ()))
+            except Exception as e:
+                logger.warning("Ignoring unreadable cache file %s: %s", file, e)
+                continue
+            # File chỉ có dòng tiêu đề (bảng rỗng) được coi như chưa tải, giống định dạng parquet
+            if not stock_data.empty:
+                stock_data_dictionary[table_name] = stock_data
+        return stock_data_dictionary or None
+
+    # Thư mục dataset Parquet của một bảng cho ngày end_date
+    def _parquet_dataset_path(self, end_date: str, table_name: str) -> Path:
+        return self._cur_path / "parquet" / end_date / table_name
 
-        #Định nghĩa các cột khóa chính để nối
-        # Cho dữ liệu tài chính, thường là sự kết hợp của ticker, year và quarter.
+    def _load_data_from_parquet(self, ticker: str, end_date: str) -> dict[str, pd.DataFrame] | None:
+        """
+        Load the data of a ticker from the Parquet datasets of the given end date.
 
-        #chuẩn hóa cột 'date' nếu có trong khóa chính
-        if 'date' in primary_keys:
-            df['date'] = pd.to_datetime(df['date'])
-            db_df['date'] = pd.to_datetime(db_df['date'])
-        # Use a left merge with an indicator to identify rows from `df` that are not in `db_df`.
-        # This is how you perform a left anti-join in pandas.
+        :param ticker: The ticker symbol for the stock
+        :param end_date: The end date used as the name of the cache folder
+        :return: A dictionary of the dataframes found (possibly only some of the tables), or None if there is none
+        """
+        stock_data_dictionary: dict[str, pd.DataFrame] = {}
+        for table_name in self._db_schema:
+            dataset_path = self._parquet_dataset_path(end_date, table_name)
+            try:
+                stock_data = read_data_from_parquet_dataset(dataset_path, ticker)
+            except Exception as e:
+                logger.warning("Ignoring unreadable Parquet data of %s in %s: %s", ticker, dataset_path, e)
+                continue
+            if stock_data is not None:
+                stock_data_dictionary[table_name] = stock_data
+        return stock_data_dictionary or None
 
-        # 1. Trộn bảng df và db_df dựa trên các khóa chính với phương pháp nối 'left' và chỉ định cột chỉ báo
-        merged_df = df.merge(db_df[primary_keys], on=primary_keys, how='left', indicator=True)
+    def _write_parquet_datasets(self, stock_data_list: list[dict[str, pd.DataFrame | None]], end_date: str):
+        """
+        Write the fetched data of all tickers to one Parquet dataset per table, partitioned by ticker.
 
-        # Lọc các bản ghi chỉ tồn tại trong df (không có trong db_df)
-        cleaned_df = merged_df[merged_df['_merge'] == 'left_only'].drop(columns=['_merge'])
-        #Trả về bảng cleaned_df chỉ chứa dữ liệu thực sự mới.
-        return cleaned_df
+        :param stock_data_list: Fetched data, one dictionary per ticker
+        :param end_date: The end date used as the name of the cache folder
+        """
+        frames_by_table: dict[str, list[pd.DataFrame]] = defaultdict(list)
+        for data in stock_data_list:
+            for k, df in data.items():
+                if isinstance(df, pd.DataFrame) and not df.empty:
+                    frames_by_table[k].append(df)
+        for table_name, frames in frames_by_table.items():
+            write_data_to_parquet_dataset(self._parquet_dataset_path(end_date, table_name),
+                                          pd.concat(frames, ignore_index=True, copy=False))
 
     # Chạy quá trình điều phối dữ liệu
+    def _write_table(self, table_name: str, table: list[pd.DataFrame]):
+        """
+        Write one table to the database: upsert for tables in UPSERT_TABLES, insert of the new rows only otherwise.
+        :param table_name: Name of the table in the schema
+        :param table: Data of all tickers for this table, one DataFrame per ticker
+        """
+        primary_keys = list(self._primary_keys.get(table_name, ()))
+
+        # Use upsert for company/profile related tables and ratio tables
+        if table_name.lower() in UPSERT_TABLES:
+            self._db_interface.upsert_data_to_db(table_name, table, primary_keys)
+        else:
+            # Chỉ chèn các bản ghi mới: PostgreSQL tự bỏ qua các dòng có khóa chính đã tồn tại (ON CONFLICT DO NOTHING),
+            # không cần tải khóa chính từ DB về để lọc trong Python
+            self._db_interface.upsert_data_to_db(table_name, table, primary_keys, update_existing=False)
+
     def run(self):
         """
         Execute the data orchestration process for fetching and storing financial data.
 
-        This method initializes a FinanceAPI instance and a results queue, calculates date ranges,
-        and uses a ThreadPoolExecutor to fetch financial data for each ticker in the listings.
-        The fetched data is processed and written to CSV files in the specified data path.
+        This method calculates date ranges and uses a ThreadPoolExecutor to fetch financial
+        data for each ticker in the listings. Tickers share one FinanceAPI instance per bearer key,
+        rotating through the available bearer keys. The fetched data is written to CSV files
+        in the specified data path by the workers (or, with file_format='parquet', to one
+        Parquet dataset per table once all tickers are fetched), then dumped to the database.
 
         The process involves:
         - Calculating the date range from eleven years ago to today.
         - Submitting fetch tasks for each ticker using a worker function.
-        - Collecting results from the queue and saving data to files.
+        - Collecting the results as they complete and saving data to the database.
 
         The method logs the progress and completion of data fetching and writing operations.
         """
-        # Khởi tạo FinanceAPI để gọi API lấy dữ liệu
-        finance_api = FinanceAPI(schema_dict=(self._db_schema or {}), bearer_key=self._bearer_keys[0])
-        # Tính toán khoảng thời gian từ 11 năm trước đến ngày hiện tại
-        eleven_years_ago = self._today - timedelta(days=365 * 11)
-        start_date = eleven_years_ago.strftime('%Y-%m-%d')
-        end_date = self._today.strftime('%Y-%m-%d')
-
-        stock_data_list = []
-        # VÒNG LẶP: Đi từng ngân hàng một
-        for _, row in self.listings_df.iterrows():
-            ticker = row['symbol']
-            #1. Kiểm tra có dùng được file cũ không (nếu có thì load từ file cũ)
-            if self._load_from_file:
-                # Loop through the files in the folder
-                cur_date_path = self._cur_path / ticker / end_date
-                stock_data_dictionary: dict[str, Any] = {'ticker': ticker}
-                # If the folder exists and has 6 files
-                # kiểm tra thư mục hiện tại có tồn tại không
-                if cur_date_path.exists():
-                    files_in_folder = list(cur_date_path.iterdir())
-                    #Kiểm tra xem có đủ 6 file không
-                    if len(files_in_folder) == 6:
-                        # Nếu có đủ 6 file, đọc từng file và lưu vào dictionary
-                        for file in files_in_folder:
-                            stock_data = pd.read_csv(file, sep=',', encoding='utf-8-sig')
-                            stem = file.stem
-                            table_name = stem.split('_', maxsplit=1)[1]
-                            stock_data_dictionary[table_name] = stock_data
-                    # Nếu không đủ 6 file, gọi API để lấy dữ liệu mới
-                    else:
-                        stock_data_dictionary = self._fetch_data_worker(start_date, end_date, finance_api, ticker)
-                # Nếu thư mục không tồn tại, gọi API để lấy dữ liệu mới           
-                else:
-                    stock_data_dictionary = self._fetch_data_worker(start_date, end_date, finance_api, ticker)
-                stock_data_list.append(stock_data_dictionary)
-            #2. Nếu không dùng file cũ thì gọi API để lấy dữ liệu mới
-            else:
-                stock_data = self._fetch_data_worker(start_date, end_date, finance_api, ticker)
-            # Thêm dữ liệu cổ phiếu vào danh sách  
-                stock_data_list.append(stock_data)
-
-        # Chuẩn bị ghi dữ liệu vào tệp và cơ sở dữ liệu
-        logger.info("Data writing process started.")
-        table_names = (k for k in stock_data_list[0].keys() if k != 'ticker')
-        tables_to_dump = {k: pd.DataFrame() for k in table_names}
-        # VÒNG LẶP: Ghi dữ liệu từng ngân hàng một
-        for data in stock_data_list:
-            ticker = data['ticker']
-            symbol_folder_path = self._cur_path / ticker
-            # Sort the file_paths by this criteria: The file names that have "company_profile" in the name will be dumped first
-            #sắp xếp các bảng để ghi vào tệp, ưu tiên bảng company_profile trước
-            for k in sorted(data.keys(), key=lambda x: 'company' in x, reverse=True):
-                df = data[k]
-                # Kiểm tra nếu df là một DataFrame hợp lệ
-                if isinstance(df, pd.DataFrame):
-                    # Lưu file ra ổ cứng
-                    file_path = symbol_folder_path / end_date / f"{ticker}_{k}.csv"
-                    write_data_to_file(file_path, df)
-
-                    # Determine primary keys for this table from schema
-                    primary_keys = (self._db_schema or {}).get(k, {}).get('primary_keys', [])
+        try:
+            # Tính toán khoảng thời gian từ 11 năm trước đến ngày hiện tại
+            eleven_years_ago = self._today - timedelta(days=365 * 11)
+            start_date = eleven_years_ago.strftime('%Y-%m-%d')
+            end_date = self._today.strftime('%Y-%m-%d')
 
-                    # For tables that should be upserted (company_profile / company and ratio),
-                    # keep all rows (we need to update existing rows), but drop duplicates within
-                    # the incoming dataframe based on primary keys.
-                    try:
-                        if k.lower() in UPSERT_TABLES:
-                            if primary_keys:
-                                df = df.drop_duplicates(subset=primary_keys)
-                            else:
-                                df = df.drop_duplicates()
-                        else:
-                            # For plain inserts, filter out records that already exist in DB
-                            df = self._delete_unnecessary_records_from_df(df, k, ticker, primary_keys)
+            symbols = self.listings_df['symbol'].to_numpy()
+            # Tạo sẵn thư mục lưu trữ của tất cả các mã một lần (mkdir parents=True tạo luôn thư mục mã),
+            # để các luồng tải không phải tạo thư mục trên đường gọi API
+            if self._file_format == "csv":
+                for ticker in symbols:
+                    make_folder(self._cur_path / ticker / end_date)
 
-                        tables_to_dump[k] = pd.concat([tables_to_dump[k], df], ignore_index=True)
-                    except Exception as e:
-                        logger.error(f"Failed with exception: {e}")
+            stock_data_list = []
+            # Gọi API song song cho nhiều ngân hàng cùng lúc (công việc chủ yếu là chờ mạng)
+            with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                futures = {}
+                #1. Kiểm tra có dùng được file cũ không (nếu có thì load từ file cũ); đọc file của các mã song song
+                cached_data = list(executor.map(lambda t: self._load_data_from_file(t, end_date), symbols)) \
+                    if self._load_from_file and self._file_format != "none" else [None] * len(symbols)
+                # Chỉ cần cột 'symbol' nên duyệt thẳng mảng giá trị thay vì iterrows() (tạo một Series cho mỗi dòng)
+                for i, ticker in enumerate(symbols):
+                    stock_data_dictionary = cached_data[i]
+                    if stock_data_dictionary is not None and all(k in stock_data_dictionary for k in self._db_schema):
+                        stock_data_list.append(stock_data_dictionary)
                         continue
-        # Since all tables refer to the ticker in company_profile, we have to dump company_profile first
-        # Sắp xếp một lần nữa để đảm bảo bảng company_profile được ghi vào cơ sở dữ liệu trước
-        for table_name, table in sorted(tables_to_dump.items(), key=lambda x: 'company' in x[0], reverse=True):
-            # Skip empty tables
-            if table.empty:
-                continue
+                    #2. Nếu không dùng file cũ (hoặc file cũ không đủ) thì gọi API để lấy dữ liệu mới
+                    # (chỉ các bảng còn thiếu nếu file cũ có một phần)
+                    # Luân phiên các bearer key giữa các mã
+                    finance_api = self._finance_apis[i % len(self._finance_apis)]
+                    futures[executor.submit(self._fetch_data_worker, start_date, end_date, finance_api, ticker,
+                                            stock_data_dictionary)] = i
+                # Thêm dữ liệu cổ phiếu vào danh sách khi từng mã tải xong
+                fetched_data_list = []
+                for future in as_completed(futures):
+                    stock_data = future.result()
+                    if stock_data:
+                        stock_data_list.append(stock_data)
+                        # Chỉ giữ các bảng vừa tải (không phải các bảng đọc từ file) để ghi ra dataset Parquet
+                        cached_tables = cached_data[futures[future]] or {}
+                        fetched_data_list.append({k: v for k, v in stock_data.items() if k not in cached_tables})
 
-            primary_keys = (self._db_schema or {}).get(table_name, {}).get('primary_keys', [])
+            # Định dạng parquet: ghi dữ liệu mới tải của tất cả các mã một lần, mỗi bảng một dataset
+            # (phân vùng của các bảng đã có trong file không bị ghi lại)
+            if self._file_format == "parquet" and fetched_data_list:
+                self._write_parquet_datasets(fetched_data_list, end_date)
 
-            # Use upsert for company/profile related tables and ratio tables
-            if table_name.lower() in UPSERT_TABLES:
-                self._db_interface.upsert_data_to_db(table_name, table, primary_keys)
-            else:
-                self._db_interface.dump_data_to_db(table_name, table)
-        # Hoàn tất quá trình ghi dữ liệu
-        logger.info("Data writing process complete.")
+            # Chuẩn bị ghi dữ liệu vào tệp và cơ sở dữ liệu
+            logger.info("Data writing process started.")
+            # Gom các DataFrame cùng loại của mọi mã vào một danh sách, cuối cùng mới nối (concat) một lần cho mỗi bảng
+            frames_by_table: dict[str, list[pd.DataFrame]] = defaultdict(list)
+            # VÒNG LẶP: Ghi dữ liệu từng ngân hàng một
+            for data in stock_data_list:
+                # Thứ tự các bảng ở đây không quan trọng: bảng company được ghi vào DB trước ở bước ghi bên dưới
+                for k, df in data.items():
+                    # Kiểm tra nếu df là một DataFrame hợp lệ
+                    if isinstance(df, pd.DataFrame):
+                        # Determine primary keys for this table from schema
+                        primary_keys = self._primary_keys.get(k, ())
 
-
-        self._db_interface.close_connection()
+                        # For tables that should be upserted (company_profile / company and ratio),
+                        # keep all rows (we need to update existing rows), but drop duplicates within
+                        # the incoming dataframe based on primary keys.
+                        try:
+                            if k.lower() in UPSERT_TABLES:
+                                if primary_keys:
+                                    df = df.drop_duplicates(subset=list(primary_keys))
+                                else:
+                                    df = df.drop_duplicates()
+                            # For plain inserts, records that already exist in DB are skipped by the
+                            # database itself when writing (see _write_table)
+                            frames_by_table[k].append(df)
+                        except Exception as e:
+                            logger.error("Failed with exception: %s", e)
+                            continue
+            # Mỗi bảng được ghi bằng một lệnh COPY/upsert duy nhất cho tất cả các mã (một commit cho mỗi bảng).
+            # Các DataFrame của từng mã được đưa thẳng vào COPY nối tiếp nhau, không concat thành một DataFrame lớn,
+            # nên bộ nhớ đỉnh không tăng theo tổng số dòng của bảng
+            tables_to_dump = {k: [df for df in frames if not df.empty] for k, frames in frames_by_table.items()}
+            # Since all tables refer to the ticker in company_profile, we have to dump company_profile first
+            # Bảng company được ghi trước (các bảng khác có khóa ngoại tới company), sau đó các bảng còn lại
+            # được ghi song song, mỗi bảng trên một kết nối riêng lấy từ connection pool
+            tables_to_dump = {k: v for k, v in tables_to_dump.items() if v}
+            for table_name in [k for k in tables_to_dump if 'company' in k]:
+                self._write_table(table_name, tables_to_dump.pop(table_name))
+            with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                futures = {executor.submit(self._write_table, k, v): k for k, v in tables_to_dump.items()}
+                # Chờ tất cả các bảng ghi xong rồi mới báo lỗi, để một bảng lỗi không làm dừng các bảng khác
+                failed_tables: dict[str, Exception] = {}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error("Failed to write %s with exception: %s", futures[future], e)
+                        failed_tables[futures[future]] = e
+            if failed_tables:
+                raise RuntimeError(f"Failed to write tables: {', '.join(sorted(failed_tables))}") \
+                    from next(iter(failed_tables.values()))
+            # Hoàn tất quá trình ghi dữ liệu
+            logger.info("Data writing process complete.")
+        finally:
+            # Luôn đóng kết nối DB và HTTP session, kể cả khi có lỗi, và trả vnstock về requests gốc
+            self._db_interface.close_connection()
+            self._http_session.close()
+            restore_vnstock_http_client()
@@ -4,7 +4,8 @@ import vnstock.explorer.tcbs.financial as tcbs_financial
 from util.utility import fixed_delay_api_call, remove_optimize_execution_decorator, transform_df, clean_dataframe, COMPANY_METHODS, FINANCE_METHODS
 import logging
 import pandas as pd
-from typing import Any
+from typing import Any, Iterable
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 tcbs_company._BASE_URL = 'https://apiextaws.tcbs.com.vn'
 tcbs_financial._BASE_URL = 'https://apiextaws.tcbs.com.vn'
@@ -27,13 +28,16 @@ for cls, methods in [(tcbs_company.Company, COMPANY_METHODS), (tcbs_financial.Fi
 
 
 class FinanceAPI:
+    # Số request HTTP tối đa mà một lần gọi build_dict có thể gửi cùng lúc: mỗi bảng dữ liệu một luồng,
+    # 4 bảng báo cáo tài chính gọi thêm báo cáo năm và quý song song (2 + 4 * 2 = 10)
+    CONCURRENT_REQUESTS = 10
+
     # Khởi tạo lớp với schema_dict (cấu trúc 6 bảng dữ liệu)
     def __init__(self, schema_dict: dict[str, Any], bearer_key: str):
         # Thiết lập ngôn ngữ và nguồn dữ liệu
 
-        # Remove the decorator from Company methods
-        self._finance = None
-        self._company = None
+        # Không lưu đối tượng Company/Finance của mã đang tải trên instance: chúng được tạo trong build_dict
+        # và truyền vào từng hàm, nên một FinanceAPI có thể được nhiều luồng dùng chung cho nhiều mã cùng lúc
         self._language = 'en'
         self._source = 'TCBS'
         # Lưu trữ schema_dict
@@ -41,15 +45,16 @@ class FinanceAPI:
         self._bearer_key = bearer_key
 
 # Định nghĩa phương thức để lấy thông tin hồ sơ công ty
-    def _get_company_profile(self, symbol: str, table_name: str) -> pd.DataFrame:
+    def _get_company_profile(self, company: tcbs_company.Company, symbol: str, table_name: str) -> pd.DataFrame:
         """
         Get company profile data
 
+        :param company: vnstock Company object of the ticker
         :param symbol: Ticker symbol of the company
         :return: Company profile data as a DataFrame
         """
         # Lấy dữ liệu tổng quan về công ty
-        company_df = self._company.overview()
+        company_df = company.overview()
         # Đổi tên cột 'symbol' thành 'ticker'
         company_df = company_df.rename(columns={'symbol': 'ticker'})
         # Hàm clean_dataframe để kiểm tra cột và xóa hàng trùng lặp theo khóa chính
@@ -57,84 +62,96 @@ class FinanceAPI:
                                    self._schema_dict[table_name]['primary_keys'])
         return final_df
 
-    def _get_company_cash_flow(self, symbol: str, table_name: str) -> pd.DataFrame:
+    @staticmethod
+    def _fetch_annual_and_quarterly(report) -> tuple[pd.DataFrame, pd.DataFrame]:
         """
-        Retrieve and merge the quarterly and annual cash flow data for a given company symbol.
+        Call a Finance report method for both periods at the same time.
+
+        :param report: Bound Finance method, e.g. finance.cash_flow
+        :return: The annual and the quarterly data
+        :raises ValueError: If one of the periods comes back empty
+        """
+        # Báo cáo quý được gọi trên một luồng phụ trong khi luồng hiện tại gọi báo cáo năm
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            quarterly_future = executor.submit(report, period="quarter")
+            annual_data = report(period="year")
+            quarterly_data = quarterly_future.result()
+        # vnstock bắt lỗi request (vd. bị giới hạn tốc độ) và trả về DataFrame rỗng thay vì báo lỗi:
+        # coi kết quả rỗng là lỗi để fixed_delay_api_call gọi lại sau một khoảng chờ
+        for period, data in (("year", annual_data), ("quarter", quarterly_data)):
+            if data is None or data.empty:
+                raise ValueError(f"Empty {getattr(report, '__name__', 'report')} data for period={period}")
+        return annual_data, quarterly_data
+
+    def _combine_statements(self, annual_data: pd.DataFrame, quarterly_data: pd.DataFrame, symbol: str,
+                            table_name: str) -> pd.DataFrame:
+        """
+        Merge the annual and quarterly data of a financial statement into one table of the schema.
 
+        :param annual_data: Annual data, indexed by report period ('2024')
+        :param quarterly_data: Quarterly data, indexed by report period ('2024-Q1')
         :param symbol: Ticker symbol of the company
-        :return: Merged cash flow data as a DataFrame
+        :param table_name: Name of the table in the schema
+        :return: Merged data as a DataFrame
         """
-        # Lấy báo cáo lưu chuyển tiền tệ hàng năm và hàng quý
-        # Tạo đối tượng Finance với symbol: mã cổ phiếu và source : nguồn dữ liệu
-        annual_data = self._finance.cash_flow(period="year")
-        quarterly_data = self._finance.cash_flow(period="quarter")
-        # Thêm cột ticker vào dữ liệu
-        annual_data['ticker'] = symbol
-        quarterly_data['ticker'] = symbol
-        # hàm transform xử lý cột thời gian : Với báo cáo quý (ví dụ "Q1-2024"): Nó tách thành cột quarter = 1 và year = 2024.
-        annual_data = transform_df(annual_data)
-        quarterly_data = transform_df(quarterly_data)
-        # Kết hợp dữ liệu hàng năm và hàng quý, sau đó làm sạch dữ liệu
+        # Nối dữ liệu năm và quý trước (giữ index kỳ báo cáo, không sắp xếp cột), rồi mới thêm cột ticker
+        # và tách năm/quý một lần trên bảng đã nối thay vì làm riêng cho từng bảng
+        combined_data = pd.concat([annual_data, quarterly_data], copy=False, sort=False)
+        combined_data['ticker'] = symbol
+        # hàm transform xử lý cột thời gian : Với báo cáo quý (ví dụ "2024-Q1"): Nó tách thành cột quarter = 1 và year = 2024.
+        combined_data = transform_df(combined_data).reset_index(drop=True)
         # clean_dataframe để sắp xếp đúng và xóa hàng trùng lặp theo khóa chính
-        final_df = clean_dataframe(pd.concat([annual_data, quarterly_data]), self._schema_dict[table_name]['columns'],
+        final_df = clean_dataframe(combined_data, self._schema_dict[table_name]['columns'],
                                    self._schema_dict[table_name]['primary_keys'])
         return final_df
+
+    def _get_company_cash_flow(self, finance: tcbs_financial.Finance, symbol: str, table_name: str) -> pd.DataFrame:
+        """
+        Retrieve and merge the quarterly and annual cash flow data for a given company symbol.
+
+        :param finance: vnstock Finance object of the ticker
+        :param symbol: Ticker symbol of the company
+        :return: Merged cash flow data as a DataFrame
+        """
+        # Lấy báo cáo lưu chuyển tiền tệ hàng năm và hàng quý
+        annual_data, quarterly_data = self._fetch_annual_and_quarterly(finance.cash_flow)
+        return self._combine_statements(annual_data, quarterly_data, symbol, table_name)
 # Bảng cân đối kế toán
 
-    def _get_company_balance_sheet(self, symbol: str, table_name: str) -> pd.DataFrame:
+    def _get_company_balance_sheet(self, finance: tcbs_financial.Finance, symbol: str, table_name: str) -> pd.DataFrame:
         """
         Retrieve and merge the quarterly and annual balance sheet data for a given company symbol.
 
+        :param finance: vnstock Finance object of the ticker
         :param symbol: Ticker symbol of the company
         :return: Merged balance sheet data as a DataFrame
         """
-        annual_data = self._finance.balance_sheet(period="year")
-        annual_data['ticker'] = symbol
-        annual_data = transform_df(annual_data)
-
-        quarterly_data = self._finance.balance_sheet(period="quarter")
-        quarterly_data['ticker'] = symbol
-        quarterly_data = transform_df(quarterly_data)
-        final_df = clean_dataframe(pd.concat([annual_data, quarterly_data]), self._schema_dict[table_name]['columns'],
-                                   self._schema_dict[table_name]['primary_keys'])
-        return final_df
+        annual_data, quarterly_data = self._fetch_annual_and_quarterly(finance.balance_sheet)
+        return self._combine_statements(annual_data, quarterly_data, symbol, table_name)
 # Báo cáo kết quả hoạt động kinh doanh
 
-    def _get_company_income_statement(self, symbol: str, table_name: str) -> pd.DataFrame:
+    def _get_company_income_statement(self, finance: tcbs_financial.Finance, symbol: str, table_name: str) -> pd.DataFrame:
         """
         Retrieve and merge the quarterly and annual income statement data for a given company symbol.
 
+        :param finance: vnstock Finance object of the ticker
         :param symbol: Ticker symbol of the company
         :return: Merged income statement data as a DataFrame
         """
-        annual_data = self._finance.income_statement(period="year")
-        annual_data['ticker'] = symbol
-        annual_data = transform_df(annual_data)
-
-        quarterly_data = self._finance.income_statement(period="quarter")
-        quarterly_data['ticker'] = symbol
-        quarterly_data = transform_df(quarterly_data)
-        final_df = clean_dataframe(pd.concat([annual_data, quarterly_data]), self._schema_dict[table_name]['columns'],
-                                   self._schema_dict[table_name]['primary_keys'])
-        return final_df
+        annual_data, quarterly_data = self._fetch_annual_and_quarterly(finance.income_statement)
+        return self._combine_statements(annual_data, quarterly_data, symbol, table_name)
 # Chỉ số tài chính
 
-    def _get_company_ratio(self, symbol: str, table_name: str) -> pd.DataFrame:
+    def _get_company_ratio(self, finance: tcbs_financial.Finance, symbol: str, table_name: str) -> pd.DataFrame:
         """
         Retrieve and merge the quarterly and annual ratio data for a given company symbol.
 
+        :param finance: vnstock Finance object of the ticker
         :param symbol: Ticker symbol of the company
         :return: Merged ratio data as a DataFrame
         """
-        annual_data = self._finance.ratio(period="year")
-        quarterly_data = self._finance.ratio(period="quarter")
-        annual_data['ticker'] = symbol
-        quarterly_data['ticker'] = symbol
-        annual_data = transform_df(annual_data)
-        quarterly_data = transform_df(quarterly_data)
-        final_df = clean_dataframe(pd.concat([annual_data, quarterly_data]), self._schema_dict[table_name]['columns'],
-                                   self._schema_dict[table_name]['primary_keys'])
-        return final_df
+        annual_data, quarterly_data = self._fetch_annual_and_quarterly(finance.ratio)
+        return self._combine_statements(annual_data, quarterly_data, symbol, table_name)
 
     # staticmethod là phương thức tĩnh không phụ thuộc vào trạng thái của đối tượng lớp
     @staticmethod
@@ -156,32 +173,50 @@ class FinanceAPI:
         price_history = price_history.rename(columns={'time': 'date'})
         return price_history
 
-    def build_dict(self, ticker: str, start_date: str, end_date: str) -> dict[str, Any]:
+    def build_dict(self, ticker: str, start_date: str, end_date: str,
+                   tables: Iterable[str] | None = None) -> dict[str, pd.DataFrame | None]:
         """
         Build a dictionary of dataframes by calling the API from vnstock
         :param ticker: Ticker symbol
         :param start_date: Start date of the price history
         :param end_date: End date of the price history
-        :return: A dictionary of dataframes
+        :param tables: Names of the tables to fetch (all tables if None)
+        :return: A dictionary of dataframes keyed by table name (None for a table that could not be fetched)
         """
         # Thay vì phải viết code thủ công để gọi 6 lần cho 6 loại dữ liệu khác nhau, hàm này sẽ gom tất cả vào một chỗ để xử lý tự động và gọn gàng.
-        self._company = vnstock.Company(symbol=ticker, source=self._source)
-        self._company.headers["Authorization"] = f"Bearer {self._bearer_key}"
-        self._finance = self._company.finance
-        self._finance.headers["Authorization"] = f"Bearer {self._bearer_key}"
+        company = vnstock.Company(symbol=ticker, source=self._source)
+        company.headers["Authorization"] = f"Bearer {self._bearer_key}"
+        finance = company.finance
+        finance.headers["Authorization"] = f"Bearer {self._bearer_key}"
         functions_to_call = {
-            "company": (self._get_company_profile, {"symbol": ticker, "table_name": "company"}),
-            "cash_flow": (self._get_company_cash_flow, {"symbol": ticker, "table_name": "cash_flow"}),
-            "balance_sheet": (self._get_company_balance_sheet, {"symbol": ticker, "table_name": "balance_sheet"}),
+            "company": (self._get_company_profile, {"company": company, "symbol": ticker, "table_name": "company"}),
+            "cash_flow": (self._get_company_cash_flow,
+                          {"finance": finance, "symbol": ticker, "table_name": "cash_flow"}),
+            "balance_sheet": (self._get_company_balance_sheet,
+                              {"finance": finance, "symbol": ticker, "table_name": "balance_sheet"}),
             "income_statement": (self._get_company_income_statement,
-                                 {"symbol": ticker, "table_name": "income_statement"}),
-            "ratio": (self._get_company_ratio, {"symbol": ticker, "table_name": "ratio"}),
+                                 {"finance": finance, "symbol": ticker, "table_name": "income_statement"}),
+            "ratio": (self._get_company_ratio, {"finance": finance, "symbol": ticker, "table_name": "ratio"}),
             "daily_price": (self._get_company_price_history_data,
                             {"symbol": ticker, "start_date": start_date, "end_date": end_date})
         }
-# tạo dictionary response để lưu trữ kết quả trả về
-        response: dict[str, Any] = {"ticker": ticker}
-# lặp qua từng mục trong functions_to_call và gọi hàm tương ứng với tham số đã cho
-        for key, (func, kwargs) in functions_to_call.items():
-            response[key] = fixed_delay_api_call(func, **kwargs)
+        if tables is not None:
+            tables = set(tables)
+            functions_to_call = {k: v for k, v in functions_to_call.items() if k in tables}
+        if not functions_to_call:
+            return {}
+# tạo dictionary response để lưu trữ kết quả trả về (giữ thứ tự các bảng như trong functions_to_call)
+        # (chỉ chứa các DataFrame: mã cổ phiếu đã có sẵn trong cột 'ticker' của từng bảng)
+        response: dict[str, pd.DataFrame | None] = dict.fromkeys(functions_to_call)
+# gọi song song các hàm trong functions_to_call: các lần gọi API độc lập với nhau và chủ yếu là chờ mạng,
+# nên thời gian tải một mã bằng lần gọi lâu nhất thay vì tổng của cả 6 lần gọi (mỗi bảng cần tải một luồng)
+        with ThreadPoolExecutor(max_workers=len(functions_to_call)) as executor:
+            futures = {executor.submit(fixed_delay_api_call, func, **kwargs): key
+                       for key, (func, kwargs) in functions_to_call.items()}
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    response[key] = future.result()
+                except Exception as e:
+                    logger.error("Failed to fetch %s for %s: %s", key, ticker, e)
         return response
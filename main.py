@@ -1,7 +1,7 @@
 from pathlib import Path
 import logging
 from dotenv import load_dotenv, find_dotenv
-from DataOrchestrator.DataOrchestrator import DataOrchestrator
+from DataOrchestrator.DataOrchestrator import DataOrchestrator, DEFAULT_REQUESTS_PER_MINUTE
 from util.utility import get_auth_info, get_banks_listings, parse_boolean
 import os
 from datetime import datetime
@@ -45,7 +45,10 @@ def main():
     logger.info("Downloading data...")
     data_orchestrator = DataOrchestrator(listing_df=listings_df, data_path=stock_data_folder,
                                          db_url=os.getenv("DATABASE_URL"), db_schema_file=Path.cwd() / "schema.sql",
-                                         load_from_file=parse_boolean(os.getenv("LOAD_FROM_FILE")), today=today, bearer_keys=bearer_keys)
+                                         load_from_file=parse_boolean(os.getenv("LOAD_FROM_FILE")), today=today, bearer_keys=bearer_keys,
+                                         max_workers=int(os.getenv("MAX_WORKERS", "4")),
+                                         file_format=os.getenv("FILE_FORMAT", "csv"),
+                                         requests_per_minute=float(os.getenv("REQUESTS_PER_MINUTE") or DEFAULT_REQUESTS_PER_MINUTE))
     data_orchestrator.run()
     # Hoàn tất
     logger.info("Done")
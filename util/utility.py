@@ -2,15 +2,26 @@
 from vnstock import Listing
 from vnstock.explorer.tcbs.company import Company
 from vnstock.explorer.tcbs.financial import Finance
+# client: Mô-đun gửi HTTP request của vnstock (gọi requests.get/post ở cấp module)
+from vnstock.core.utils import client as vnstock_client
 from pathlib import Path
 import pandas as pd
+# pyarrow: Bộ đọc CSV viết bằng C++ (đa luồng) và định dạng Parquet
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import time
+import threading
+import os
 import random
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from types import SimpleNamespace
 # Nhập thư viện Regular Expression (biểu thức chính quy) để xử lý văn bản mạnh mẽ
 import re
 import logging
-from typing import Any, Type
+from typing import Any, Iterable, Type
 
 # Cấu hình logging cơ bản cho các tiện ích này
 logging.basicConfig(
@@ -22,6 +33,10 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.setLevel("INFO")
 
+# Giá trị của cột quarter cho báo cáo cả năm (quý 1-4 là báo cáo quý).
+# Cột quarter nằm trong khóa chính (ticker, year, quarter) của các bảng báo cáo tài chính.
+ANNUAL_QUARTER = 5
+
 def make_folder(stock_data_path: Path) -> None:
     """
     Hàm tiện ích: Tạo thư mục nếu nó chưa tồn tại.
@@ -29,7 +44,7 @@ def make_folder(stock_data_path: Path) -> None:
     :param stock_data_path: Đường dẫn thư mục cần tạo.
     """
     if not stock_data_path.exists():
-        logger.info(f"Creating folder {stock_data_path=}")
+        logger.info("Creating folder stock_data_path=%r", stock_data_path)
         # mkdir(parents=True, exist_ok=True) là cách an toàn nhất để tạo thư mục đa cấp
         stock_data_path.mkdir(parents=True, exist_ok=True)
 
@@ -39,9 +54,69 @@ def write_data_to_file(stock_data_file: Path, stock_data: pd.DataFrame) -> None:
     :param stock_data_file: Đường dẫn file đích.
     :param stock_data: Dữ liệu cần ghi.
     """
-    logger.info(f"Writing data to {stock_data_file=}")
-    # Sử dụng encoding='utf-8-sig' để hỗ trợ tốt tiếng Việt khi mở bằng Excel
-    stock_data.to_csv(stock_data_file, index=False, encoding='utf-8-sig')
+    logger.info("Writing data to stock_data_file=%r", stock_data_file)
+    # Ghi ra một file tạm cùng thư mục rồi đổi tên (os.replace là thao tác nguyên tử): nếu chương trình bị dừng
+    # giữa chừng, file đích hoặc còn nguyên bản cũ hoặc đã là bản mới đầy đủ, không bao giờ bị ghi dở
+    tmp_file = stock_data_file.with_name(f".{stock_data_file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        # File CSV dành cho người đọc (mở bằng Excel) nên giữ bộ ghi của pandas: ngày dạng 2024-01-02,
+        # số thực không bị đổi sang dạng 1.2e+12, boolean là True/False
+        # Sử dụng encoding='utf-8-sig' để hỗ trợ tốt tiếng Việt khi mở bằng Excel
+        stock_data.to_csv(tmp_file, index=False, encoding='utf-8-sig')
+        os.replace(tmp_file, stock_data_file)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+
+def read_data_from_file(stock_data_file: Path, text_columns: Iterable[str] = ()) -> pd.DataFrame:
+    """
+    Hàm tiện ích: Đọc lại file CSV được ghi bởi write_data_to_file.
+    Dùng bộ đọc CSV đa luồng của pyarrow (bỏ qua BOM UTF-8) thay cho pd.read_csv.
+    :param stock_data_file: Đường dẫn file cần đọc.
+    :param text_columns: Các cột luôn được đọc dưới dạng chuỗi (vd. các cột VARCHAR trong schema),
+        để giá trị như "01" không bị đổi thành số.
+    :return: Dữ liệu dưới dạng DataFrame.
+    """
+    # strings_can_be_null=True: ô rỗng của cột chuỗi được đọc thành NULL (NaN như pd.read_csv), không phải ''
+    convert_options = pacsv.ConvertOptions(strings_can_be_null=True,
+                                           column_types={c: pa.string() for c in text_columns})
+    table = pacsv.read_csv(stock_data_file, read_options=pacsv.ReadOptions(use_threads=True),
+                           convert_options=convert_options)
+    # Cột toàn giá trị rỗng được Arrow đọc thành kiểu null; đổi sang float64 (NaN) giống pd.read_csv
+    table = table.cast(pa.schema([f.with_type(pa.float64()) if pa.types.is_null(f.type) else f
+                                  for f in table.schema]))
+    return table.to_pandas(self_destruct=True)
+
+
+def write_data_to_parquet_dataset(dataset_path: Path, stock_data: pd.DataFrame, partition_cols: tuple[str, ...] = ("ticker",)) -> None:
+    """
+    Hàm tiện ích: Ghi một DataFrame (dữ liệu của nhiều mã) ra một dataset Parquet, chia thư mục theo partition_cols.
+    Phân vùng đã có của các mã được ghi lại sẽ bị thay thế, các mã khác giữ nguyên.
+    Dữ liệu được nén bằng zstd (nhỏ hơn nhiều so với CSV, đọc lại không phải chuyển đổi số <-> chuỗi).
+    :param dataset_path: Thư mục gốc của dataset.
+    :param stock_data: Dữ liệu cần ghi.
+    :param partition_cols: Các cột dùng để chia thư mục (mặc định theo mã cổ phiếu).
+    """
+    logger.info("Writing data to dataset_path=%r", dataset_path)
+    pq.write_to_dataset(pa.Table.from_pandas(stock_data, preserve_index=False), root_path=dataset_path,
+                        partition_cols=list(partition_cols), existing_data_behavior="delete_matching",
+                        compression="zstd", compression_level=3)
+
+
+def read_data_from_parquet_dataset(dataset_path: Path, ticker: str) -> pd.DataFrame | None:
+    """
+    Hàm tiện ích: Đọc dữ liệu của một mã từ dataset Parquet được ghi bởi write_data_to_parquet_dataset.
+    :param dataset_path: Thư mục gốc của dataset.
+    :param ticker: Mã cổ phiếu cần đọc.
+    :return: DataFrame của mã, hoặc None nếu dataset không có phân vùng của mã này.
+    """
+    if not (dataset_path / f"ticker={ticker}").exists():
+        return None
+    # filters chỉ mở các file trong thư mục ticker=<mã>, không phải đọc dữ liệu của các mã khác
+    stock_data = pq.read_table(dataset_path, filters=[("ticker", "==", ticker)]).to_pandas()
+    # Cột phân vùng được đọc lại dưới dạng category, đổi về chuỗi như dữ liệu gốc
+    stock_data["ticker"] = stock_data["ticker"].astype(str)
+    return stock_data
 
 
 def get_banks_listings(testing: bool = False) -> pd.DataFrame:
@@ -77,36 +152,30 @@ def transform_df(dataframe: pd.DataFrame) -> pd.DataFrame:
     Hàm xử lý quan trọng: Chuẩn hóa cột thời gian (Năm/Quý) cho các báo cáo tài chính.
     Dữ liệu từ vnstock có thể có index dạng '2022-Q1' (quý) hoặc '2022' (năm).
     Hàm này tách chúng ra thành 2 cột rõ ràng: 'year' và 'quarter'.
+    Lưu ý: không sao chép dataframe đầu vào, các cột mới có thể được thêm thẳng vào nó.
     """
-    df = dataframe.copy()
-    # Xóa các cột cũ nếu có để tránh xung đột
-    drop_columns = ['report_period', 'year', 'quarter']
-    for col in drop_columns:
-        if col in df.columns:
-            df = df.drop(col, axis=1)
+    df = dataframe
+    # Xóa các cột cũ nếu có để tránh xung đột (một lần drop cho tất cả các cột)
+    drop_columns = [col for col in ['report_period', 'year', 'quarter'] if col in df.columns]
+    if drop_columns:
+        df = df.drop(columns=drop_columns)
 
     # Nếu đã có sẵn year và quarter thì không cần làm gì thêm (đề phòng)
     if 'year' in df.columns and 'quarter' in df.columns:
         return df
 
-    # Hàm con hỗ trợ xử lý từng dòng index
-    def extract_year_quarter(index_val):
-        index_str = str(index_val)
-        if '-' in index_str:
-            # Đây là báo cáo quý, ví dụ: '2022-Q1' -> Tách thành year=2022, quarter=1
-            year_str, quarter_str = index_str.split('-')
-            year = int(year_str)
-            quarter = int(quarter_str.replace('Q', ''))
-            return pd.Series([year, quarter])
-        else:
-            # Đây là báo cáo năm, ví dụ: '2022' -> year=2022.
-            # Quy ước quarter = 5 để biểu thị dữ liệu cả năm (annual).
-            year = int(index_str)
-            quarter = 5
-            return pd.Series([year, quarter])
-
-    # Áp dụng hàm con vào index để tạo ra 2 cột mới
-    df[['year', 'quarter']] = df.index.to_series().apply(extract_year_quarter)
+    # Tách index bằng các phép xử lý chuỗi vector hóa của pandas thay vì gọi hàm Python cho từng dòng:
+    # '2022-Q1' (báo cáo quý) -> year=2022, quarter=1
+    # '2022' (báo cáo năm) -> year=2022, quarter=ANNUAL_QUARTER (quy ước quarter = 5 để biểu thị dữ liệu cả năm)
+    parts = pd.Series(df.index.astype(str), index=df.index, dtype=object).str.partition('-')
+    if parts.empty:
+        df['year'] = pd.Series(dtype='int64')
+        df['quarter'] = pd.Series(dtype='int64')
+        return df
+    quarter = parts[2].str.replace('Q', '', regex=False)
+    # .to_numpy(): gán theo vị trí, không căn theo index (index kỳ báo cáo có thể trùng sau khi nối năm và quý)
+    df['year'] = parts[0].astype('int64').to_numpy()
+    df['quarter'] = quarter.where(quarter != '', str(ANNUAL_QUARTER)).astype('int64').to_numpy()
 
     return df
 
@@ -122,13 +191,12 @@ def clean_dataframe(df: pd.DataFrame, table_schema: list[str], primary_key_cols:
     # Tìm các cột có trong thiết kế (schema) nhưng chưa có trong dữ liệu tải về
     missing_columns = [col for col in table_schema if col not in df.columns]
 
-    # Thêm các cột thiếu đó vào và điền giá trị None
     for col in missing_columns:
-        df[col] = None
-        logger.info(f"Added missing column: '{col}'")
+        logger.info("Added missing column: '%s'", col)
 
-    # Sắp xếp lại thứ tự các cột cho khớp y hệt với thiết kế trong schema.sql
-    df = df[table_schema]
+    # Thêm các cột thiếu (để trống) và sắp xếp lại thứ tự các cột cho khớp y hệt với thiết kế trong schema.sql
+    # trong một bước reindex, thay vì thêm từng cột một rồi chọn lại các cột (mỗi bước đều tạo lại DataFrame)
+    df = df.reindex(columns=table_schema)
 
     # 2. Xử lý dòng trùng lặp
     # Kiểm tra xem các cột khóa chính có tồn tại trong file không
@@ -138,10 +206,11 @@ def clean_dataframe(df: pd.DataFrame, table_schema: list[str], primary_key_cols:
         df.drop_duplicates(subset=primary_key_cols, keep='first', inplace=True)
         dropped_rows = initial_row_count - len(df)
         if dropped_rows > 0:
-            logger.info(f"Removed {dropped_rows} duplicate rows based on the primary key.")
+            logger.info("Removed %d duplicate rows based on the primary key.", dropped_rows)
     else:
         # Nếu không đủ cột khóa chính thì cảnh báo và bỏ qua bước lọc trùng (hiếm khi xảy ra nếu code đúng)
-        logger.info(f"Warning: Primary key columns {tuple(primary_key_cols)} not found in the DataFrame. Skipping duplicate removal.")
+        logger.info("Warning: Primary key columns %s not found in the DataFrame. Skipping duplicate removal.",
+                    tuple(primary_key_cols))
 
     return df
 
@@ -150,7 +219,7 @@ def clean_dataframe(df: pd.DataFrame, table_schema: list[str], primary_key_cols:
 
 def prepare_quarter_table() -> pd.DataFrame:
     # Tạo bảng danh mục Quý (1, 2, 3, 4, và 5 cho cả năm)
-    quarter = pd.DataFrame({'quarter': [1, 2, 3, 4, 5]})
+    quarter = pd.DataFrame({'quarter': [1, 2, 3, 4, ANNUAL_QUARTER]})
     return quarter
 
 def prepare_year_table(years: list[int]) -> pd.DataFrame:
@@ -158,10 +227,11 @@ def prepare_year_table(years: list[int]) -> pd.DataFrame:
     year = pd.DataFrame({'year': years})
     return year
 
-def prepare_dates_table(dates_list: list[pd.Timestamp]) -> pd.DataFrame:
-    # Tạo bảng danh mục Ngày, có thêm cột Năm
-    dates = pd.DataFrame({'date': dates_list})
-    dates['year'] = dates['date'].dt.year
+def prepare_dates_table(dates_list: pd.DatetimeIndex | list[pd.Timestamp]) -> pd.DataFrame:
+    # Tạo bảng danh mục Ngày, có thêm cột Năm.
+    # Nhận trực tiếp DatetimeIndex (vd. pd.date_range) để không phải tạo list các đối tượng Timestamp
+    dates_index = pd.DatetimeIndex(dates_list)
+    dates = pd.DataFrame({'date': dates_index, 'year': dates_index.year})
     return dates
 
 # ---------------------------------------------------------
@@ -171,7 +241,7 @@ def get_table_schemas_from_sql(filepath):
     Hàm phân tích file .sql để "hiểu" cấu trúc database mà không cần kết nối DB.
     Nó đọc file schema.sql và dùng biểu thức chính quy (Regex) để trích xuất:
     - Tên các bảng
-    - Danh sách các cột trong mỗi bảng
+    - Danh sách các cột trong mỗi bảng (và kiểu dữ liệu của từng cột)
     - Khóa chính (Primary Keys)
     - Khóa ngoại (Foreign Keys)
 
@@ -199,6 +269,7 @@ def get_table_schemas_from_sql(filepath):
                         # Khởi tạo cấu trúc lưu trữ cho bảng mới tìm thấy
                         table_schemas[current_table] = {
                             'columns': [],
+                            'column_types': {},
                             'primary_keys': [],
                             'foreign_keys': []
                         }
@@ -233,12 +304,14 @@ def get_table_schemas_from_sql(filepath):
 
                     # Nếu không phải là định nghĩa khóa, thì nó là một dòng định nghĩa CỘT.
                     # Regex đơn giản này giả định từ đầu tiên trong dòng là tên cột.
-                    col_match = re.match(r'`?(\w+)`?', line)
+                    col_match = re.match(r'`?(\w+)`?(?:\s+(\w+))?', line)
                     if col_match:
                         column_name = col_match.group(1)
                         # Tránh nhầm lẫn các từ khóa ràng buộc (CONSTRAINT, KEY...) là tên cột
                         if column_name.upper() not in ['CONSTRAINT', 'PRIMARY', 'FOREIGN', 'KEY']:
                              table_schemas[current_table]['columns'].append(column_name)
+                             # Kiểu dữ liệu của cột (từ thứ hai trong dòng, vd. VARCHAR, INT, FLOAT)
+                             table_schemas[current_table]['column_types'][column_name] = (col_match.group(2) or '').upper()
 
     except FileNotFoundError:
         print(f"Error: The file '{filepath}' was not found.")
@@ -249,32 +322,37 @@ def get_table_schemas_from_sql(filepath):
 
     return table_schemas
 
-# Hàm để gọi API với độ trễ cố định nhằm tránh vượt quá giới hạn API
+# Số lần gọi lại tối đa và thời gian chờ (giây) giữa các lần gọi lại khi gọi API lỗi:
+# chờ tăng gấp đôi sau mỗi lần lỗi (30s, 60s, 120s), cộng thêm một khoảng ngẫu nhiên để các luồng không gọi lại cùng lúc
+# (tổng cộng tối đa khoảng 210s cho một lần gọi lỗi liên tục)
+API_MAX_ATTEMPTS = 4
+API_BACKOFF_BASE = 30
+API_BACKOFF_CAP = 120
+API_BACKOFF_JITTER = 5
+
+# Hàm để gọi API, gọi lại với thời gian chờ tăng dần khi có lỗi (vd. vượt quá giới hạn API)
 def fixed_delay_api_call(function, **kwargs) -> pd.DataFrame:
     """Make API calls and pause the program
     when API limits has been reached.
+    Failed calls are retried up to API_MAX_ATTEMPTS times with exponential backoff and jitter.
     :param function: The function to call
     :param kwargs: Keyword arguments for the function
     :returns: A pandas DataFrame or None if an error occurs
     """
-    # Ghi lại thời gian bắt đầu
     # Gọi hàm với tham số đã cho và xử lý lỗi nếu có
     value = None
-    # Try 3 times. If all fails, return None. If one succeeds, break the loop
-    for i in range(3):
-        # start = time.perf_counter() + 1
+    # Try API_MAX_ATTEMPTS times. If all fails, return None. If one succeeds, break the loop
+    for attempt in range(API_MAX_ATTEMPTS):
         try:
             value = function(**kwargs)
         except Exception as e:
-            logger.error(f"Error calling API with {function=}, {kwargs=}: {e}")
-            if i < 2:
-                time.sleep(60 + random.uniform(0, 5))
+            # Chỉ ghi tên hàm và mã cổ phiếu: kwargs chứa các đối tượng Company/Finance, repr của chúng dài và vô ích
+            logger.error("Error calling API %s for %s (attempt %d/%d): %s", getattr(function, "__name__", function),
+                         kwargs.get("symbol"), attempt + 1, API_MAX_ATTEMPTS, e)
+            if attempt < API_MAX_ATTEMPTS - 1:
+                time.sleep(min(API_BACKOFF_CAP, API_BACKOFF_BASE * 2 ** attempt) + random.uniform(0, API_BACKOFF_JITTER))
         else:
-            # diff = time.perf_counter() - start
-            # if diff > 0:
-            #     time.sleep(diff + 1)
-            # else:
-            #     time.sleep(1)
+            # Không chờ sau một lần gọi thành công: giới hạn tốc độ gọi API do RateLimiter đảm nhiệm
             break
 
     return value
@@ -355,6 +433,107 @@ def remove_optimize_execution_decorator(cls: Type[Any], method_names: list[str])
                 setattr(cls, method_name, original_method.__wrapped__)  # Replace with undecorated version
 
 
+class RateLimiter:
+    """
+    Bộ giới hạn tốc độ kiểu token bucket, dùng chung an toàn giữa nhiều luồng.
+    Mỗi request lấy một token; token được nạp lại đều đặn với tốc độ requests_per_minute / 60 mỗi giây,
+    tối đa burst token (số request được phép gửi dồn cùng lúc).
+    """
+    def __init__(self, requests_per_minute: float, burst: int = 1):
+        if requests_per_minute <= 0:
+            raise ValueError("requests_per_minute must be positive")
+        self._rate = requests_per_minute / 60
+        self._capacity = max(1, burst)
+        self._tokens = float(self._capacity)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Chờ cho đến khi có token rồi lấy một token."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._last_refill) * self._rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            # Ngủ ngoài khóa để các luồng khác vẫn kiểm tra được
+            time.sleep(wait)
+
+
+class RateLimitedRetry(Retry):
+    """
+    urllib3 Retry that takes a token from a RateLimiter before every retry attempt.
+    urllib3 retries inside a single session.get/post call, so without this only the first attempt would be rate limited.
+    """
+
+    def __init__(self, *args, rate_limiter: RateLimiter | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = rate_limiter
+
+    def new(self, **kwargs) -> "RateLimitedRetry":
+        # urllib3 tạo đối tượng Retry mới sau mỗi lần thử: giữ lại rate_limiter
+        kwargs.setdefault("rate_limiter", self.rate_limiter)
+        return super().new(**kwargs)
+
+    def increment(self, *args, **kwargs) -> "RateLimitedRetry":
+        # increment() được gọi trước mỗi lần thử lại (và báo lỗi khi đã hết số lần thử)
+        new_retry = super().increment(*args, **kwargs)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        return new_retry
+
+
+# Đối tượng 'requests' gốc của mô-đun client vnstock, trước khi use_shared_http_session thay thế
+_VNSTOCK_REQUESTS = vnstock_client.requests
+
+
+def use_shared_http_session(pool_size: int, rate_limiter: RateLimiter | None = None) -> requests.Session:
+    """
+    Make every vnstock API call go through one shared requests.Session.
+    vnstock sends its requests with the module-level requests.get/post, which open a new TCP + TLS
+    connection for every call; a Session keeps the connections alive and reuses them across tickers and threads.
+    Transient connection errors and 429/5xx responses to GET requests are retried with exponential backoff,
+    each retry also waiting for a token from rate_limiter.
+    :param pool_size: Number of connections kept per host (should match the number of worker threads)
+    :param rate_limiter: If given, every request waits for a token from it before being sent
+    :return: The session, to be closed by the caller when all API calls are done
+    """
+    session = requests.Session()
+    # Lỗi mạng tạm thời và các mã 429/5xx được thử lại ngay ở tầng kết nối (chờ 1s, 2s, 4s),
+    # trước khi fixed_delay_api_call phải chờ cả phút để gọi lại toàn bộ hàm.
+    # Mỗi lần thử lại cũng phải lấy một token của rate_limiter, để REQUESTS_PER_MINUTE vẫn được tôn trọng
+    # đúng lúc server đang giới hạn (429)
+    retry = RateLimitedRetry(total=3, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+                             raise_on_status=False, rate_limiter=rate_limiter)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    get, post = session.get, session.post
+    if rate_limiter is not None:
+        def rate_limited(send):
+            def call(*args, **kwargs):
+                rate_limiter.acquire()
+                return send(*args, **kwargs)
+            return call
+
+        get, post = rate_limited(get), rate_limited(post)
+    # Thay 'requests' trong mô-đun client của vnstock bằng đối tượng có get/post của session
+    # (restore_vnstock_http_client() đặt lại như cũ)
+    vnstock_client.requests = SimpleNamespace(get=get, post=post, exceptions=requests.exceptions)
+    return session
+
+
+def restore_vnstock_http_client() -> None:
+    """
+    Undo use_shared_http_session: vnstock sends its requests with the module-level requests.get/post again.
+    Call it once the shared session is closed, so vnstock does not keep pointing at a closed session.
+    """
+    vnstock_client.requests = _VNSTOCK_REQUESTS
+
+
 COMPANY_METHODS = [
     "overview", "profile", "shareholders", "insider_deals",
     "subsidiaries", "officers", "events", "news", "dividends"